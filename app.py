@@ -1,11 +1,19 @@
-import base64
 import datetime
+import hashlib
+import html
 import io
 import mimetypes
 import os
+import re
+import secrets
+import struct
+import threading
+import time
 import unicodedata
 import uuid
-from typing import Any, Dict, List, Optional, Sequence, Tuple
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence, Tuple
 
 import json
 
@@ -14,11 +22,16 @@ import streamlit.components.v1 as components
 from PIL import Image
 
 from basic_setting import (
+    _write_file_atomic,
+    decode_base64_strict,
     decode_image_data,
     get_secret_value,
     init_history,
+    load_history_image,
+    mark_history_entry_changed,
     persist_history_to_storage,
     require_login,
+    resolve_persist_future,
     sync_cookie_controller,
 )
 
@@ -27,22 +40,22 @@ try:
 except ImportError:
     StreamlitSecretNotFoundError = Exception
 
-try:
-    from google import genai
-    from google.api_core import exceptions as google_exceptions
-    from google.genai import types
+if TYPE_CHECKING:
     from google.cloud import storage
-except ImportError:
-    st.error(
-        "必要なライブラリが不足しています。`pip install -r requirements.txt` を実行してください。"
-    )
-    st.stop()
+
+MISSING_LIBRARIES_MESSAGE = "必要なライブラリが不足しています。`pip install -r requirements.txt` を実行してください。"
 
 
 TITLE = "脳内大喜利"
 APP_TITLE = "脳内大喜利"
 MODEL_NAME = "models/gemini-2.5-flash-image"
 IMAGE_ASPECT_RATIO = "16:9"
+REFERENCE_THUMB_HEIGHT = 200
+JPEG_QUALITY = 82
+MAX_HISTORY = 20
+INLINE_HISTORY_LIMIT = 5
+GENERATION_DEDUP_SECONDS = 30
+STATIC_DIR = os.path.join(os.path.dirname(__file__), "static")
 REFERENCE_IMAGES = [
     {
         "label": "IKKOさん",
@@ -77,6 +90,8 @@ REFERENCE_IMAGES = [
         "path": os.path.join(os.path.dirname(__file__), "ガチャピン.jpeg"),
     },
 ]
+REFERENCE_LABELS = [reference["label"] for reference in REFERENCE_IMAGES]
+REFERENCE_ALT_TEXTS = [html.escape(label) for label in REFERENCE_LABELS]
 DEFAULT_PROMPT_SUFFIX = (
     "((masterpiece, best quality, ultra-detailed, photorealistic, 8k, sharp focus))"
 )
@@ -87,6 +102,26 @@ NO_TEXT_TOGGLE_SUFFIX = (
     "((no background text, no symbols, no markings, no letters anywhere, no typography, "
     "no signboard, no watermark, no logo, no text, no subtitles, no labels, no poster elements, neutral background))"
 )
+PROMPT_STATIC_SUFFIX = "\n".join([REFERENCE_EDIT_INSTRUCTION, DEFAULT_PROMPT_SUFFIX, NO_TEXT_TOGGLE_SUFFIX])
+_FILENAME_TRANSLATION = str.maketrans(
+    {
+        **{chr(code): None for code in range(32)},
+        **{char: None for char in '\\/:*?"<>|'},
+        "\n": "-n-",
+        "\r": "-n-",
+    }
+)
+_WHITESPACE_RE = re.compile(r"\s")
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_JPEG_SOF_MARKERS = frozenset(
+    {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+)
+GCS_UPLOAD_CHUNK_SIZE = 256 * 1024
+GCS_RESUMABLE_THRESHOLD = 4 * GCS_UPLOAD_CHUNK_SIZE
+GCS_CACHE_CONTROL = "private, max-age=31536000, immutable"
+GCS_PRECONNECT_ORIGIN = "https://storage.googleapis.com"
+SIGNED_URL_TTL = datetime.timedelta(hours=1)
+SIGNED_URL_CACHE_SECONDS = 50 * 60
 
 DEFAULT_GEMINI_API_KEY = (
     get_secret_value("GEMINI_API_KEY")
@@ -96,6 +131,112 @@ DEFAULT_GEMINI_API_KEY = (
 )
 
 
+HISTORY_CONTAINER_KEY = "history"
+LIGHTBOX_STYLE = f"""
+.st-key-history [data-testid="stImage"] {{
+    content-visibility: auto;
+    contain-intrinsic-size: auto 400px;
+}}
+.st-key-history [data-testid="stImage"] img {{
+    aspect-ratio: {IMAGE_ASPECT_RATIO.replace(":", " / ")};
+    object-fit: contain;
+    border-radius: 12px;
+    cursor: zoom-in;
+    transition: transform 0.16s ease-in-out;
+    box-shadow: 0 4px 14px rgba(0, 0, 0, 0.12);
+}}
+.st-key-history [data-testid="stImage"] img:hover {{
+    transform: scale(1.02);
+}}
+"""
+LIGHTBOX_SCRIPT = """
+(function () {
+    if (window.__streamlitLightbox) {
+        return;
+    }
+    let overlay = null;
+    let keyHandler = null;
+
+    function hide() {
+        if (!overlay) {
+            return;
+        }
+        const closing = overlay;
+        overlay = null;
+        closing.style.opacity = "0";
+        document.body.style.overflow = closing.getAttribute("data-original-overflow") || "";
+        setTimeout(function () {
+            if (closing.parentNode) {
+                closing.parentNode.removeChild(closing);
+            }
+        }, 180);
+        if (keyHandler) {
+            window.removeEventListener("keydown", keyHandler);
+            keyHandler = null;
+        }
+    }
+
+    function show(src) {
+        hide();
+        const current = document.createElement("div");
+        current.id = "streamlit-lightbox-overlay";
+        current.style.position = "fixed";
+        current.style.zIndex = "10000";
+        current.style.top = "0";
+        current.style.left = "0";
+        current.style.right = "0";
+        current.style.bottom = "0";
+        current.style.display = "flex";
+        current.style.justifyContent = "center";
+        current.style.alignItems = "center";
+        current.style.background = "rgba(0, 0, 0, 0.92)";
+        current.style.cursor = "zoom-out";
+        current.style.opacity = "0";
+        current.style.transition = "opacity 0.18s ease-in-out";
+        current.setAttribute("data-original-overflow", document.body.style.overflow || "");
+        document.body.style.overflow = "hidden";
+
+        const full = document.createElement("img");
+        full.src = src;
+        full.alt = "Generated image fullscreen";
+        full.style.maxWidth = "100vw";
+        full.style.maxHeight = "100vh";
+        full.style.objectFit = "contain";
+        full.style.boxShadow = "0 20px 45px rgba(0, 0, 0, 0.5)";
+        full.style.borderRadius = "0";
+
+        current.appendChild(full);
+        current.addEventListener("click", hide);
+
+        keyHandler = function (event) {
+            if (event.key === "Escape") {
+                hide();
+            }
+        };
+        window.addEventListener("keydown", keyHandler);
+
+        document.body.appendChild(current);
+        overlay = current;
+        requestAnimationFrame(function () {
+            current.style.opacity = "1";
+        });
+    }
+
+    window.__streamlitLightbox = { show, hide };
+    document.addEventListener("click", function (event) {
+        const target = event.target;
+        if (!target || target.tagName !== "IMG") {
+            return;
+        }
+        if (!target.closest('.st-key-history [data-testid="stImage"]')) {
+            return;
+        }
+        show(target.currentSrc || target.src);
+    });
+})();
+"""
+
+
 def get_current_api_key() -> Optional[str]:
     api_key = st.session_state.get("config_api_key")
     if isinstance(api_key, str) and api_key.strip():
@@ -109,8 +250,16 @@ def load_configured_api_key() -> str:
 
 
 
-def load_reference_image_bytes(path: str) -> Optional[bytes]:
-    if not os.path.exists(path):
+def get_file_mtime(path: str) -> Optional[float]:
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+@st.cache_data(show_spinner=False, max_entries=len(REFERENCE_IMAGES))
+def load_reference_image_bytes(path: str, mtime: Optional[float]) -> Optional[bytes]:
+    if mtime is None:
         return None
     try:
         with open(path, "rb") as file_handle:
@@ -119,6 +268,15 @@ def load_reference_image_bytes(path: str) -> Optional[bytes]:
         return None
 
 
+def _list_normalized_entries(directory: str) -> Dict[str, str]:
+    normalized: Dict[str, str] = {}
+    for entry in os.listdir(directory):
+        normalized.setdefault(entry, entry)
+        normalized.setdefault(unicodedata.normalize("NFC", entry), entry)
+        normalized.setdefault(unicodedata.normalize("NFD", entry), entry)
+    return normalized
+
+
 def resolve_reference_path(path: Optional[str]) -> Optional[str]:
     if not path:
         return None
@@ -129,24 +287,56 @@ def resolve_reference_path(path: Optional[str]) -> Optional[str]:
     if not os.path.isdir(directory):
         return None
     try:
-        entries = os.listdir(directory)
+        entries = _list_normalized_entries(directory)
     except Exception:
         return None
-    desired = {
-        unicodedata.normalize("NFC", filename),
-        unicodedata.normalize("NFD", filename),
-    }
-    for entry in entries:
-        normalized_entry = {
-            entry,
-            unicodedata.normalize("NFC", entry),
-            unicodedata.normalize("NFD", entry),
-        }
-        if desired & normalized_entry:
+    for desired in (unicodedata.normalize("NFC", filename), unicodedata.normalize("NFD", filename)):
+        entry = entries.get(desired)
+        if entry is not None:
             return os.path.join(directory, entry)
     return None
 
 
+@st.cache_resource(show_spinner=False)
+def _resolve_reference_paths() -> List[Optional[str]]:
+    return [resolve_reference_path(reference["path"]) for reference in REFERENCE_IMAGES]
+
+
+@st.cache_resource(show_spinner=False)
+def _preload_reference_images() -> Dict[str, bytes]:
+    preloaded: Dict[str, bytes] = {}
+    resolved_paths = _resolve_reference_paths()
+    for index, reference in enumerate(REFERENCE_IMAGES):
+        path = resolved_paths[index]
+        if not path:
+            continue
+        try:
+            with open(path, "rb", buffering=1 << 16) as file_handle:
+                preloaded[reference["label"]] = file_handle.read()
+        except OSError:
+            continue
+    return preloaded
+
+
+def get_reference_image_bytes(label: str, path: Optional[str]) -> Optional[bytes]:
+    preloaded = _preload_reference_images().get(label)
+    if preloaded is not None:
+        return preloaded
+    if not path:
+        return None
+    return load_reference_image_bytes(path, get_file_mtime(path))
+
+
+@st.cache_resource(show_spinner=False)
+def get_reference_part(label: str, path: Optional[str]) -> Any:
+    image_bytes = get_reference_image_bytes(label, path)
+    if not image_bytes:
+        return None
+    from google.genai import types
+
+    return types.Part.from_bytes(data=image_bytes, mime_type=get_image_mime_type(path))
+
+
 def get_image_mime_type(path: Optional[str]) -> str:
     if not path:
         return "image/jpeg"
@@ -156,9 +346,41 @@ def get_image_mime_type(path: Optional[str]) -> str:
     return "image/jpeg"
 
 
+def _parse_header_dimensions(image_bytes: bytes) -> Optional[Tuple[int, int]]:
+    if image_bytes[:8] == _PNG_SIGNATURE and len(image_bytes) >= 24 and image_bytes[12:16] == b"IHDR":
+        width, height = struct.unpack(">II", image_bytes[16:24])
+        return width, height
+    if image_bytes[:2] != b"\xff\xd8":
+        return None
+    index = 2
+    length = len(image_bytes)
+    while index + 4 <= length:
+        if image_bytes[index] != 0xFF:
+            return None
+        marker = image_bytes[index + 1]
+        if marker == 0xFF:
+            index += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+            index += 2
+            continue
+        (segment_length,) = struct.unpack(">H", image_bytes[index + 2 : index + 4])
+        if marker in _JPEG_SOF_MARKERS:
+            if index + 9 > length:
+                return None
+            height, width = struct.unpack(">HH", image_bytes[index + 5 : index + 9])
+            return width, height
+        index += 2 + segment_length
+    return None
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
 def get_image_dimensions(image_bytes: Optional[bytes]) -> Optional[Tuple[int, int]]:
     if not image_bytes:
         return None
+    dimensions = _parse_header_dimensions(image_bytes)
+    if dimensions is not None:
+        return dimensions
     try:
         with Image.open(io.BytesIO(image_bytes)) as image:
             return image.width, image.height
@@ -166,25 +388,98 @@ def get_image_dimensions(image_bytes: Optional[bytes]) -> Optional[Tuple[int, in
         return None
 
 
+def _hash_image_bytes(image_bytes: bytes) -> bytes:
+    return hashlib.blake2b(image_bytes, digest_size=8).digest()
+
+
+@st.cache_data(show_spinner=False, hash_funcs={bytes: _hash_image_bytes})
 def resize_image_bytes_to_height(image_bytes: Optional[bytes], target_height: int) -> Optional[bytes]:
     if not image_bytes:
         return None
     if target_height <= 0:
         return image_bytes
+    dimensions = _parse_header_dimensions(image_bytes)
+    if dimensions is not None and dimensions[1] <= target_height:
+        return image_bytes
+    return build_jpeg_thumbnail(image_bytes, target_height) or image_bytes
+
+
+def _encode_progressive_jpeg(image: Image.Image) -> bytes:
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        rgba = image.convert("RGBA")
+        flattened = Image.new("RGB", rgba.size, (255, 255, 255))
+        flattened.paste(rgba, mask=rgba.getchannel("A"))
+    else:
+        flattened = image.convert("RGB")
+    buffer = io.BytesIO()
+    flattened.save(buffer, format="JPEG", quality=JPEG_QUALITY, progressive=True, optimize=True)
+    return buffer.getvalue()
+
+
+def build_jpeg_thumbnail(image_bytes: Optional[bytes], target_height: int) -> Optional[bytes]:
+    if not image_bytes or target_height <= 0:
+        return None
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            if image.format == "JPEG" and image.height > target_height:
+                draft_width = max(1, image.width * target_height // image.height)
+                image.draft("RGB", (draft_width * 2, target_height * 2))
+            image.thumbnail((image.width, target_height), Image.BILINEAR)
+            return _encode_progressive_jpeg(image)
+    except Exception:
+        return None
+
+
+def transcode_to_jpeg(image_bytes: bytes) -> bytes:
     try:
         with Image.open(io.BytesIO(image_bytes)) as image:
-            width, height = image.size
-            if height <= 0:
+            if image.format == "JPEG":
                 return image_bytes
-            scale = target_height / height
-            target_width = max(1, int(width * scale))
-            resized = image.resize((target_width, target_height), Image.LANCZOS)
-            buffer = io.BytesIO()
-            save_format = image.format if image.format else "PNG"
-            resized.save(buffer, format=save_format)
-            return buffer.getvalue()
+            transcoded = _encode_progressive_jpeg(image)
     except Exception:
         return image_bytes
+    return transcoded if len(transcoded) < len(image_bytes) else image_bytes
+
+
+@st.cache_resource(show_spinner=False)
+def _build_reference_thumbs() -> Dict[int, bytes]:
+    preloaded = _preload_reference_images()
+    thumbs: Dict[int, bytes] = {}
+    for index, reference in enumerate(REFERENCE_IMAGES):
+        thumb = build_jpeg_thumbnail(preloaded.get(reference["label"]), REFERENCE_THUMB_HEIGHT)
+        if thumb is not None:
+            thumbs[index] = thumb
+    return thumbs
+
+
+@st.cache_resource(show_spinner=False)
+def _write_static_reference_thumbs() -> Dict[int, str]:
+    static_urls: Dict[int, str] = {}
+    try:
+        os.makedirs(STATIC_DIR, exist_ok=True)
+    except OSError:
+        return static_urls
+    preloaded = _preload_reference_images()
+    resolved_paths = _resolve_reference_paths()
+    for index, reference in enumerate(REFERENCE_IMAGES):
+        source_path = resolved_paths[index]
+        if not source_path:
+            continue
+        source_digest = hashlib.sha256(source_path.encode("utf-8")).hexdigest()[:16]
+        filename = f"ref_{source_digest}_{REFERENCE_THUMB_HEIGHT}.jpg"
+        thumb_path = os.path.join(STATIC_DIR, filename)
+        thumb_mtime = get_file_mtime(thumb_path)
+        source_mtime = get_file_mtime(source_path)
+        if thumb_mtime is None or source_mtime is None or thumb_mtime < source_mtime:
+            thumb = build_jpeg_thumbnail(preloaded.get(reference["label"]), REFERENCE_THUMB_HEIGHT)
+            if thumb is None:
+                continue
+            try:
+                _write_file_atomic(thumb_path, [thumb])
+            except OSError:
+                continue
+        static_urls[index] = f"app/static/{filename}"
+    return static_urls
 
 
 def extract_parts(candidate: object) -> Sequence:
@@ -195,9 +490,32 @@ def extract_parts(candidate: object) -> Sequence:
     return parts or []
 
 
+def _get_part_payload(part: object, name: str) -> object:
+    container = getattr(part, name, None)
+    if container is None and isinstance(part, dict):
+        container = part.get(name)
+    data = getattr(container, "data", None)
+    if data is None and isinstance(container, dict):
+        data = container.get("data")
+    return data
+
+
 def collect_image_bytes(response: object) -> Optional[bytes]:
+    saw_parts = False
+    for candidate in getattr(response, "candidates", None) or ():
+        for part in extract_parts(candidate):
+            saw_parts = True
+            decoded = decode_image_data(_get_part_payload(part, "inline_data"))
+            if decoded:
+                return decoded
+    if saw_parts:
+        return None
+    return _collect_image_bytes_fallback(response)
+
+
+def _collect_image_bytes_fallback(response: object) -> Optional[bytes]:
     visited: set[int] = set()
-    queue: List[object] = []
+    queue: deque = deque()
 
     if response is not None:
         queue.append(response)
@@ -225,10 +543,8 @@ def collect_image_bytes(response: object) -> Optional[bytes]:
                 return decoded
         return None
 
-    base64_charset = set("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=\n\r")
-
     while queue:
-        current = queue.pop(0)
+        current = queue.popleft()
         if current is None:
             continue
 
@@ -245,10 +561,20 @@ def collect_image_bytes(response: object) -> Optional[bytes]:
 
         if isinstance(current, str):
             candidate = current.strip()
-            if len(candidate) > 80 and set(candidate) <= base64_charset:
-                decoded = decode_image_data(candidate)
-                if decoded:
-                    return decoded
+            if len(candidate) <= 80:
+                continue
+            try:
+                candidate_bytes = candidate.encode("ascii")
+            except UnicodeEncodeError:
+                continue
+            if (len(candidate_bytes) - candidate_bytes.count(b"\n") - candidate_bytes.count(b"\r")) % 4:
+                continue
+            decoded = decode_base64_strict(candidate_bytes)
+            if decoded:
+                return decoded
+            continue
+
+        if isinstance(current, (int, float)):
             continue
 
         obj_id = id(current)
@@ -256,6 +582,10 @@ def collect_image_bytes(response: object) -> Optional[bytes]:
             continue
         visited.add(obj_id)
 
+        if isinstance(current, (list, tuple)):
+            queue.extend(current)
+            continue
+
         if isinstance(current, dict):
             inline = current.get("inline_data")
             decoded = handle_inline(inline)
@@ -299,7 +629,7 @@ def collect_image_bytes(response: object) -> Optional[bytes]:
                 queue.append(value)
 
         if isinstance(current, Sequence) and not isinstance(current, (str, bytes, bytearray, memoryview)):
-            queue.extend(list(current))
+            queue.extend(current)
 
     return None
 
@@ -339,20 +669,7 @@ def _get_from_container(container: object, key: str) -> Optional[Any]:
 
 def sanitize_filename_component(value: str, max_length: int = 80) -> str:
     text = value or ""
-    sanitized_chars: List[str] = []
-    for char in text:
-        if char in {"\n", "\r"}:
-            sanitized_chars.append("-n-")
-            continue
-        if ord(char) < 32:
-            continue
-        if char in {'\\', '/', ':', '*', '?', '"', '<', '>', '|'}:
-            continue
-        if char.isspace():
-            sanitized_chars.append("_")
-            continue
-        sanitized_chars.append(char)
-    sanitized = "".join(sanitized_chars).strip("_")
+    sanitized = _WHITESPACE_RE.sub("_", text.translate(_FILENAME_TRANSLATION)).strip("_")
     if not sanitized:
         sanitized = "prompt"
     if len(sanitized) > max_length:
@@ -360,28 +677,46 @@ def sanitize_filename_component(value: str, max_length: int = 80) -> str:
     return sanitized
 
 
-def build_prompt_based_filename(prompt_text: str) -> str:
+def build_prompt_based_filename(prompt_text: str, unique_suffix: Optional[str] = None) -> str:
     prompt_component = sanitize_filename_component(prompt_text or "prompt", max_length=80)
-    unique_suffix = uuid.uuid4().hex
+    unique_suffix = unique_suffix or secrets.token_hex(8)
     return f"user01_{prompt_component}_{unique_suffix}.png"
 
 
-def upload_image_to_gcs(
-    image_bytes: bytes,
-    filename_prefix: str = "gemini_image",
-    object_name: Optional[str] = None,
-) -> Tuple[Optional[str], Optional[str]]:
-    if not image_bytes:
-        return None, None
+@st.cache_resource(show_spinner=False)
+def _get_storage_client(
+    credentials_digest: str,
+    project_id: Optional[str],
+    _service_account_info: Dict[str, Any],
+) -> "storage.Client":
+    from google.cloud import storage
 
+    return storage.Client.from_service_account_info(_service_account_info, project=project_id)
+
+
+@st.cache_data(show_spinner=False)
+def _load_service_account_info(service_account_json: Any) -> Tuple[Any, str]:
+    if isinstance(service_account_json, dict):
+        digest_source = json.dumps(service_account_json, sort_keys=True)
+        service_account_info = service_account_json
+    else:
+        digest_source = service_account_json
+        try:
+            service_account_info = json.loads(service_account_json)
+        except json.JSONDecodeError:
+            service_account_info = json.loads(service_account_json, strict=False)
+    return service_account_info, hashlib.sha256(digest_source.encode("utf-8")).hexdigest()
+
+
+def get_gcs_bucket() -> Optional["storage.Bucket"]:
     try:
         secrets_obj = st.secrets
     except StreamlitSecretNotFoundError:
         st.warning("GCPの設定が見つからないためアップロードをスキップしました。")
-        return None, None
+        return None
     except Exception as exc:  # noqa: BLE001
         st.error(f"GCPの設定取得時にエラーが発生しました: {exc}")
-        return None, None
+        return None
 
     gcp_section = None
     if isinstance(secrets_obj, dict):
@@ -391,7 +726,7 @@ def upload_image_to_gcs(
 
     if not gcp_section:
         st.warning("GCPの設定が見つからないためアップロードをスキップしました。")
-        return None, None
+        return None
 
     bucket_name = _get_from_container(gcp_section, "bucket_name")
     service_account_json = _get_from_container(gcp_section, "service_account_json")
@@ -399,282 +734,301 @@ def upload_image_to_gcs(
 
     if not bucket_name or not service_account_json:
         st.warning("GCPの設定のうち bucket_name または service_account_json が不足しています。")
-        return None, None
+        return None
 
     service_account_info: Optional[Dict[str, Any]] = None
     if isinstance(service_account_json, (dict,)):
-        service_account_info = dict(service_account_json)
+        service_account_info, credentials_digest = _load_service_account_info(dict(service_account_json))
     elif isinstance(service_account_json, (str, bytes)):
         raw_json = service_account_json.decode("utf-8") if isinstance(service_account_json, bytes) else service_account_json
-        raw_json = raw_json.strip()
         try:
-            service_account_info = json.loads(raw_json)
-        except json.JSONDecodeError:
-            try:
-                service_account_info = json.loads(raw_json, strict=False)
-            except json.JSONDecodeError as exc:
-                st.error(f"service_account_json の読み込みに失敗しました: {exc}")
-                return None, None
+            service_account_info, credentials_digest = _load_service_account_info(raw_json.strip())
+        except json.JSONDecodeError as exc:
+            st.error(f"service_account_json の読み込みに失敗しました: {exc}")
+            return None
     else:
         st.error("service_account_json の形式が不明です。文字列または辞書で設定してください。")
-        return None, None
+        return None
 
     if not isinstance(service_account_info, dict):
         st.error("service_account_json の内容が辞書形式ではありません。")
-        return None, None
+        return None
 
     try:
-        storage_client = storage.Client.from_service_account_info(
+        storage_client = _get_storage_client(
+            credentials_digest,
+            str(project_id) if project_id else None,
             service_account_info,
-            project=str(project_id) if project_id else None,
         )
-        bucket = storage_client.bucket(str(bucket_name))
-        if object_name:
-            cleaned_object_name = object_name.strip()
-            if not cleaned_object_name.lower().endswith(".png"):
-                cleaned_object_name = f"{cleaned_object_name}.png"
-            cleaned_object_name = cleaned_object_name.replace("/", "_").replace("\\", "_")
-            filename = f"images/{cleaned_object_name}"
-        else:
-            timestamp = datetime.datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-            filename = f"images/{filename_prefix}_{timestamp}_{uuid.uuid4().hex}.png"
-        blob = bucket.blob(filename)
-        blob.upload_from_file(io.BytesIO(image_bytes), content_type="image/png")
+        return storage_client.bucket(str(bucket_name))
+    except ImportError:
+        st.error(MISSING_LIBRARIES_MESSAGE)
+        return None
+    except Exception as exc:  # noqa: BLE001
+        st.error(f"GCSへのアップロードに失敗しました: {exc}")
+        return None
+
+
+def build_gcs_object_path(filename_prefix: str = "gemini_image", object_name: Optional[str] = None) -> str:
+    if object_name:
+        cleaned_object_name = object_name.strip()
+        if not cleaned_object_name.lower().endswith(".png"):
+            cleaned_object_name = f"{cleaned_object_name}.png"
+        cleaned_object_name = cleaned_object_name.replace("/", "_").replace("\\", "_")
+        return f"images/{cleaned_object_name}"
+    timestamp = datetime.datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    return f"images/{filename_prefix}_{timestamp}_{secrets.token_hex(8)}.png"
 
-        gcs_path = f"gs://{bucket.name}/{filename}"
-        signed_url = blob.generate_signed_url(
+
+def _upload_blob(bucket: "storage.Bucket", filename: str, image_bytes: bytes) -> Tuple[str, str]:
+    if len(image_bytes) <= GCS_RESUMABLE_THRESHOLD:
+        blob = bucket.blob(filename)
+        blob.cache_control = GCS_CACHE_CONTROL
+        blob.upload_from_string(image_bytes, content_type="image/png", if_generation_match=0)
+    else:
+        blob = bucket.blob(filename, chunk_size=GCS_UPLOAD_CHUNK_SIZE)
+        blob.cache_control = GCS_CACHE_CONTROL
+        blob.upload_from_file(
+            io.BytesIO(image_bytes),
+            size=len(image_bytes),
+            content_type="image/png",
+            if_generation_match=0,
+        )
+    return f"gs://{bucket.name}/{filename}", filename
+
+
+def get_signed_url(blob_name: str) -> Optional[str]:
+    signed_urls: Dict[str, Tuple[str, float]] = st.session_state.setdefault("_signed_urls", {})
+    now = time.time()
+    for cached_name, (_, signed_at) in list(signed_urls.items()):
+        if now - signed_at > SIGNED_URL_CACHE_SECONDS:
+            del signed_urls[cached_name]
+    cached = signed_urls.get(blob_name)
+    if cached is not None:
+        return cached[0]
+    bucket = get_gcs_bucket()
+    if bucket is None:
+        return None
+    try:
+        signed_url = bucket.blob(blob_name).generate_signed_url(
             version="v4",
-            expiration=datetime.timedelta(hours=1),
+            expiration=SIGNED_URL_TTL,
             method="GET",
         )
-        return gcs_path, signed_url
+    except Exception:  # noqa: BLE001
+        return None
+    signed_urls[blob_name] = (signed_url, now)
+    return signed_url
+
+
+@st.cache_resource(show_spinner=False)
+def _get_upload_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="gcs_upload")
+
+
+def submit_image_upload(
+    image_bytes: bytes,
+    filename_prefix: str = "gemini_image",
+    object_name: Optional[str] = None,
+) -> Optional[Future]:
+    if not image_bytes:
+        return None
+    bucket = get_gcs_bucket()
+    if bucket is None:
+        return None
+    filename = build_gcs_object_path(filename_prefix, object_name)
+    return _get_upload_executor().submit(_upload_blob, bucket, filename, image_bytes)
+
+
+def resolve_upload_future(entry: Dict[str, object]) -> bool:
+    future = entry.get("upload_future")
+    if not isinstance(future, Future) or not future.done():
+        return False
+    entry.pop("upload_future", None)
+    try:
+        gcs_path, blob_name = future.result()
     except Exception as exc:  # noqa: BLE001
-        st.error(f"GCSへのアップロードに失敗しました: {exc}")
-        return None, None
+        st.toast(f"GCSへのアップロードに失敗しました: {exc}")
+        return False
+    entry["gcs_path"] = gcs_path
+    entry["gcs_object"] = blob_name
+    mark_history_entry_changed(entry.get("id"))
+    return True
 
 
+def trim_history() -> None:
+    history = st.session_state.history
+    del history[MAX_HISTORY:]
+    for entry in history[INLINE_HISTORY_LIMIT:]:
+        if entry.get("image_bytes") and (entry.get("image_path") or entry.get("gcs_object")):
+            entry["image_bytes"] = None
 
 
 def ensure_lightbox_assets() -> None:
+    if st.session_state.get("_lightbox_injected"):
+        return
     components.html(
-        """
+        f"""
         <script>
-        (function () {
+        (function () {{
             const parentWindow = window.parent;
-            if (!parentWindow) {
+            if (!parentWindow || !parentWindow.document) {{
                 return;
-            }
-
-            try {
-                delete parentWindow.__streamlitLightbox;
-            } catch (err) {
-                parentWindow.__streamlitLightbox = undefined;
-            }
-            parentWindow.__streamlitLightboxInitialized = false;
+            }}
             const doc = parentWindow.document;
-
-            if (!doc.getElementById("streamlit-lightbox-style")) {
-                const style = doc.createElement("style");
-                style.id = "streamlit-lightbox-style";
-                style.textContent = `
-                .streamlit-lightbox-thumb {
-                    width: 100%;
-                    display: block;
-                    border-radius: 12px;
-                    cursor: pointer;
-                    transition: transform 0.16s ease-in-out;
-                    box-shadow: 0 4px 14px rgba(0, 0, 0, 0.12);
-                    margin: 0 auto 0.75rem auto;
-                }
-                .streamlit-lightbox-thumb:hover {
-                    transform: scale(1.02);
-                }
-                `;
-                doc.head.appendChild(style);
-            }
-
-            parentWindow.__streamlitLightbox = (function () {
-                let overlay = null;
-                let keyHandler = null;
-
-                function hide() {
-                    if (!overlay) {
-                        return;
-                    }
-                    overlay.style.opacity = "0";
-                    const originalOverflow = overlay.getAttribute("data-original-overflow") || "";
-                    doc.body.style.overflow = originalOverflow;
-                    setTimeout(function () {
-                        if (overlay && overlay.parentNode) {
-                            overlay.parentNode.removeChild(overlay);
-                        }
-                        overlay = null;
-                    }, 180);
-                    if (keyHandler) {
-                        parentWindow.removeEventListener("keydown", keyHandler);
-                        keyHandler = null;
-                    }
-                }
-
-                function show(src) {
-                    hide();
-                    overlay = doc.createElement("div");
-                    overlay.id = "streamlit-lightbox-overlay";
-                    overlay.style.position = "fixed";
-                    overlay.style.zIndex = "10000";
-                    overlay.style.top = "0";
-                    overlay.style.left = "0";
-                    overlay.style.right = "0";
-                    overlay.style.bottom = "0";
-                    overlay.style.display = "flex";
-                    overlay.style.justifyContent = "center";
-                    overlay.style.alignItems = "center";
-                    overlay.style.background = "rgba(0, 0, 0, 0.92)";
-                    overlay.style.cursor = "zoom-out";
-                    overlay.style.opacity = "0";
-                    overlay.style.transition = "opacity 0.18s ease-in-out";
-                    overlay.setAttribute("data-original-overflow", doc.body.style.overflow || "");
-                    doc.body.style.overflow = "hidden";
-
-                    const full = doc.createElement("img");
-                    full.src = src;
-                    full.alt = "Generated image fullscreen";
-                    full.style.maxWidth = "100vw";
-                    full.style.maxHeight = "100vh";
-                    full.style.objectFit = "contain";
-                    full.style.boxShadow = "0 20px 45px rgba(0, 0, 0, 0.5)";
-                    full.style.borderRadius = "0";
-
-                    overlay.appendChild(full);
-                    overlay.addEventListener("click", hide);
-
-                    keyHandler = function (event) {
-                        if (event.key === "Escape") {
-                            hide();
-                        }
-                    };
-                    parentWindow.addEventListener("keydown", keyHandler);
-
-                    doc.body.appendChild(overlay);
-                    requestAnimationFrame(function () {
-                        overlay.style.opacity = "1";
-                    });
-                }
-
-                return { show, hide };
-            })();
-        })();
+            if (doc.getElementById("streamlit-lightbox-script")) {{
+                return;
+            }}
+            const style = doc.createElement("style");
+            style.id = "streamlit-lightbox-style";
+            style.textContent = {json.dumps(LIGHTBOX_STYLE)};
+            doc.head.appendChild(style);
+            const preconnect = doc.createElement("link");
+            preconnect.rel = "preconnect";
+            preconnect.href = {json.dumps(GCS_PRECONNECT_ORIGIN)};
+            doc.head.appendChild(preconnect);
+            const script = doc.createElement("script");
+            script.id = "streamlit-lightbox-script";
+            script.textContent = {json.dumps(LIGHTBOX_SCRIPT)};
+            doc.head.appendChild(script);
+        }})();
         </script>
         """,
         height=0,
         scrolling=False,
     )
+    st.session_state["_lightbox_injected"] = True
 
 
-def render_clickable_image(image_bytes: bytes, element_id: str) -> None:
-    ensure_lightbox_assets()
-    encoded = base64.b64encode(image_bytes).decode("utf-8")
-    image_src = f"data:image/png;base64,{encoded}"
-    image_src_json = json.dumps(image_src)
-    components.html(
-        f"""<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="utf-8">
-    <style>
-        body {{
-            margin: 0;
-            padding: 0;
-            background: transparent;
-        }}
-        img {{
-            width: 100%;
-            display: block;
-            border-radius: 12px;
-            cursor: pointer;
-            transition: transform 0.16s ease-in-out;
-            box-shadow: 0 4px 14px rgba(0, 0, 0, 0.12);
-        }}
-        img:hover {{
-            transform: scale(1.02);
-        }}
-    </style>
-</head>
-<body>
-    <img id="thumb" src="{image_src}" alt="Generated image">
-    <script>
-    (function() {{
-        const img = document.getElementById("thumb");
-        if (!img) {{
-            return;
-        }}
+def get_valid_image_url(entry: Dict[str, object]) -> Optional[str]:
+    blob_name = entry.get("gcs_object")
+    if not isinstance(blob_name, str) or not blob_name:
+        return None
+    return get_signed_url(blob_name)
 
-        function resizeFrame() {{
-            const frame = window.frameElement;
-            if (!frame) {{
-                return;
-            }}
-            const frameWidth = frame.getBoundingClientRect().width || img.naturalWidth || img.clientWidth || 0;
-            const ratio = img.naturalWidth ? (img.naturalHeight / Math.max(img.naturalWidth, 1)) : (img.clientHeight / Math.max(img.clientWidth, 1) || 1);
-            const height = frameWidth ? Math.max(160, frameWidth * ratio) : (img.clientHeight || img.naturalHeight || 320);
-            frame.style.height = height + "px";
-        }}
-
-        if (img.complete) {{
-            resizeFrame();
-        }} else {{
-            img.addEventListener("load", resizeFrame);
-        }}
-        window.addEventListener("resize", resizeFrame);
-        setTimeout(resizeFrame, 60);
-
-        img.addEventListener("click", function() {{
-            if (window.parent && window.parent.__streamlitLightbox) {{
-                window.parent.__streamlitLightbox.show({image_src_json});
-            }}
-        }});
-    }})();
-    </script>
-</body>
-</html>
-""",
-        height=400,
-        scrolling=False,
-    )
+
+def render_clickable_image(image: Any) -> None:
+    if isinstance(image, (bytes, bytearray)):
+        output_format = "JPEG" if image.startswith(b"\xff\xd8") else "PNG"
+    else:
+        output_format = "auto"
+    st.image(image, width="stretch", output_format=output_format)
 
 
 def render_history() -> None:
     if not st.session_state.history:
         return
 
+    needs_persist = False
+    ensure_lightbox_assets()
     st.subheader("履歴")
-    for entry in st.session_state.history:
-        image_bytes = entry.get("image_bytes")
-        prompt_text = entry.get("prompt") or ""
-        if image_bytes:
-            image_id = entry.get("id")
-            if not isinstance(image_id, str):
-                image_id = f"img_{uuid.uuid4().hex}"
-                entry["id"] = image_id
-            render_clickable_image(image_bytes, image_id)
-        prompt_display = prompt_text.strip()
-        st.markdown("**Prompt**")
-        if prompt_display:
-            st.text(prompt_display)
-        else:
-            st.text("(未入力)")
-        st.divider()
+    with st.container(key=HISTORY_CONTAINER_KEY):
+        for entry in st.session_state.history:
+            write_failed = resolve_persist_future(entry)
+            upload_resolved = resolve_upload_future(entry)
+            needs_persist = needs_persist or write_failed or upload_resolved
+            image_url = get_valid_image_url(entry)
+            image_bytes = None if image_url else load_history_image(entry)
+            prompt_text = entry.get("prompt") or ""
+            if image_url or image_bytes:
+                if not isinstance(entry.get("id"), str):
+                    entry["id"] = f"img_{uuid.uuid4().hex}"
+                render_clickable_image(image_url or image_bytes)
+            prompt_display = prompt_text.strip()
+            st.markdown("**Prompt**")
+            if prompt_display:
+                st.text(prompt_display)
+            else:
+                st.text("(未入力)")
+            st.divider()
+    if needs_persist:
+        persist_history_to_storage()
+
+
+def load_genai_modules() -> Tuple[Any, Any, Any]:
+    try:
+        from google import genai
+        from google.api_core import exceptions as google_exceptions
+        from google.genai import types
+    except ImportError:
+        st.error(MISSING_LIBRARIES_MESSAGE)
+        st.stop()
+    return genai, types, google_exceptions
+
+
+@st.cache_resource(show_spinner=False)
+def get_genai_client(api_key: str) -> Any:
+    from google import genai
+
+    return genai.Client(api_key=api_key)
+
+
+@st.cache_resource(show_spinner=False)
+def warm_up_genai_connection(api_key: str) -> Optional[threading.Thread]:
+    try:
+        client = get_genai_client(api_key)
+    except Exception:  # noqa: BLE001
+        return None
+
+    def warm_up() -> None:
+        try:
+            next(iter(client.models.list(config={"page_size": 1})), None)
+        except Exception:  # noqa: BLE001
+            pass
+
+    thread = threading.Thread(target=warm_up, name="genai_warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+class MissingImageDataError(Exception):
+    pass
+
+
+def generate_image_bytes(client: Any, reference_part: Any, prompt_for_request: str, model: str) -> bytes:
+    from google.genai import types
+
+    response = client.models.generate_content(
+        model=model,
+        contents=[
+            prompt_for_request,
+            reference_part,
+        ],
+        config=types.GenerateContentConfig(
+            response_modalities=["TEXT", "IMAGE"],
+            image_config=types.ImageConfig(aspect_ratio=IMAGE_ASPECT_RATIO),
+        ),
+    )
+    image_bytes = collect_image_bytes(response)
+    if not image_bytes:
+        raise MissingImageDataError()
+    return image_bytes
+
+
+def get_unconsumed_generation(request_key: Tuple[str, ...]) -> Optional[bytes]:
+    # A click that lands while a generation is running interrupts that run
+    # after the API call returns; hand its result to the rerun instead of
+    # paying for the same request again.
+    last = st.session_state.get("_last_generation")
+    if not last or last["consumed"] or last["key"] != request_key:
+        return None
+    if time.monotonic() - last["at"] > GENERATION_DEDUP_SECONDS:
+        return None
+    return last["image_bytes"]
 
 
 def main() -> None:
     st.set_page_config(page_title=TITLE, page_icon="🧠", layout="centered")
     sync_cookie_controller()
-    init_history()
+    init_history(MAX_HISTORY)
+    trim_history()
     require_login()
 
     st.title(APP_TITLE)
 
     api_key = load_configured_api_key()
+    if api_key:
+        warm_up_genai_connection(api_key.strip())
 
     prompt = st.text_area(
         "Prompt",
@@ -684,7 +1038,7 @@ def main() -> None:
     reference_index = st.radio(
         "",
         options=list(range(len(REFERENCE_IMAGES))),
-        format_func=lambda idx: REFERENCE_IMAGES[idx]["label"],
+        format_func=REFERENCE_LABELS.__getitem__,
         horizontal=True,
     )
     try:
@@ -697,16 +1051,25 @@ def main() -> None:
         else None
     )
     reference_path = reference_entry["path"] if reference_entry else None
-    resolved_reference_path = resolve_reference_path(reference_path) if reference_path else None
+    resolved_reference_path = _resolve_reference_paths()[reference_index_value] if reference_entry else None
     active_reference_path = resolved_reference_path or reference_path
-    reference_thumb = (
-        load_reference_image_bytes(active_reference_path) if active_reference_path else None
-    )
-    if reference_thumb:
-        resized_thumb = resize_image_bytes_to_height(reference_thumb, 200)
-        st.image(resized_thumb)
+    static_thumb_url = _write_static_reference_thumbs().get(reference_index_value)
+    if static_thumb_url:
+        st.markdown(
+            f'<img src="{static_thumb_url}" alt="{REFERENCE_ALT_TEXTS[reference_index_value]}">',
+            unsafe_allow_html=True,
+        )
     else:
-        st.warning("参照画像のサムネイルを読み込めませんでした。")
+        reference_thumb = _build_reference_thumbs().get(reference_index_value)
+        if reference_thumb is None:
+            reference_bytes = (
+                get_reference_image_bytes(reference_entry["label"], active_reference_path) if reference_entry else None
+            )
+            reference_thumb = resize_image_bytes_to_height(reference_bytes, REFERENCE_THUMB_HEIGHT)
+        if reference_thumb:
+            st.image(reference_thumb)
+        else:
+            st.warning("参照画像のサムネイルを読み込めませんでした。")
 
     if st.button("Generate", type="primary"):
         if not api_key:
@@ -719,33 +1082,29 @@ def main() -> None:
             st.error("参照画像が未選択です。")
             st.stop()
 
-        client = genai.Client(api_key=api_key.strip())
+        _, _, google_exceptions = load_genai_modules()
+        client = get_genai_client(api_key.strip())
         stripped_prompt = prompt.rstrip()
-        prompt_components: List[str] = []
-        if stripped_prompt:
-            prompt_components.append(stripped_prompt)
-        prompt_components.append(REFERENCE_EDIT_INSTRUCTION)
-        prompt_components.extend([DEFAULT_PROMPT_SUFFIX, NO_TEXT_TOGGLE_SUFFIX])
-        prompt_for_request = "\n".join(prompt_components)
-        reference_image_bytes = load_reference_image_bytes(active_reference_path)
-        if not reference_image_bytes:
+        prompt_for_request = (
+            f"{stripped_prompt}\n{PROMPT_STATIC_SUFFIX}" if stripped_prompt else PROMPT_STATIC_SUFFIX
+        )
+        reference_part = get_reference_part(reference_entry["label"], active_reference_path)
+        if reference_part is None:
             st.error("参照画像を読み込めませんでした。")
             st.stop()
-        reference_mime_type = get_image_mime_type(active_reference_path)
 
+        request_key = (prompt_for_request, reference_entry["label"], active_reference_path, MODEL_NAME)
+        image_bytes = get_unconsumed_generation(request_key)
         with st.spinner("画像を生成しています..."):
             try:
-                response = client.models.generate_content(
-                    model=MODEL_NAME,
-                    contents=[
-                        prompt_for_request,
-                        types.Part.from_bytes(data=reference_image_bytes, mime_type=reference_mime_type),
-                    ],
-                    config=types.GenerateContentConfig(
-                        response_modalities=["TEXT", "IMAGE"],
-                        image_config=types.ImageConfig(aspect_ratio=IMAGE_ASPECT_RATIO),
-                    ),
-                )
+                if image_bytes is None:
+                    image_bytes = generate_image_bytes(client, reference_part, prompt_for_request, MODEL_NAME)
+                    st.session_state["_last_generation"] = {
+                        "key": request_key,
+                        "at": time.monotonic(),
+                        "image_bytes": image_bytes,
+                        "consumed": False,
+                    }
             except google_exceptions.ResourceExhausted:
                 st.error(
                     "Gemini API のクォータ（無料枠または請求プラン）を超えました。"
@@ -756,30 +1115,32 @@ def main() -> None:
             except google_exceptions.GoogleAPICallError as exc:
                 st.error(f"API 呼び出しに失敗しました: {exc.message}")
                 st.stop()
+            except MissingImageDataError:
+                st.error("画像データを取得できませんでした。")
+                st.stop()
             except Exception as exc:  # noqa: BLE001
                 st.error(f"予期しないエラーが発生しました: {exc}")
                 st.stop()
 
-        image_bytes = collect_image_bytes(response)
-        if not image_bytes:
-            st.error("画像データを取得できませんでした。")
-            st.stop()
-
         user_prompt = prompt.strip()
-        object_name = build_prompt_based_filename(user_prompt)
-        upload_image_to_gcs(image_bytes, object_name=object_name)
+        entry_token = secrets.token_hex(8)
+        object_name = build_prompt_based_filename(user_prompt, entry_token)
+        upload_future = submit_image_upload(image_bytes, object_name=object_name)
 
         st.session_state.history.insert(
             0,
             {
-                "id": f"img_{uuid.uuid4().hex}",
-                "image_bytes": image_bytes,
+                "id": f"img_{entry_token}",
+                "image_bytes": transcode_to_jpeg(image_bytes),
+                "upload_future": upload_future,
                 "prompt": user_prompt,
                 "model": MODEL_NAME,
                 "no_text": True,
             },
         )
+        st.session_state["_last_generation"]["consumed"] = True
         persist_history_to_storage()
+        trim_history()
         st.success("生成完了")
 
     render_history()
@@ -1,14 +1,21 @@
 import base64
-import datetime
+import binascii
+import functools
+import hashlib
+import hmac
 import json
 import os
+import re
+import shutil
 import tempfile
 import time
 import uuid
-from typing import Any, Dict, List, Optional, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 import streamlit as st
 import streamlit.components.v1 as components
+from streamlit.errors import DuplicateWidgetID
 
 try:
     from streamlit_cookies_controller import CookieController
@@ -20,7 +27,38 @@ try:
 except ImportError:
     StreamlitSecretNotFoundError = Exception
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pybase64
+except ImportError:
+    pybase64 = None
+
+HISTORY_IO_BUFFER_SIZE = 1 << 20
+COOKIE_WRITE_SETTLE_SECONDS = 0.6
+UNSAFE_ID_CHARS = re.compile(r"[^\w-]")
+
+
+_b64decode = pybase64.b64decode if pybase64 is not None else base64.b64decode
+_b64decode_lenient = pybase64.b64decode if pybase64 is not None else binascii.a2b_base64
 
+
+def _json_dumps(value: object) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value).encode("utf-8")
+
+
+def _json_loads(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+@functools.lru_cache(maxsize=None)
 def get_secret_value(key: str) -> Optional[str]:
     try:
         secrets_obj = st.secrets
@@ -58,12 +96,57 @@ def decode_image_data(data: Optional[object]) -> Optional[bytes]:
         return data
     if isinstance(data, str):
         try:
-            return base64.b64decode(data)
+            return _b64decode_lenient(data)
         except (ValueError, TypeError):
             return None
     return None
 
 
+def decode_base64_strict(data: bytes) -> Optional[bytes]:
+    try:
+        return _b64decode(data.translate(None, b"\r\n"), validate=True)
+    except (ValueError, TypeError):
+        return None
+
+
+def _write_file_atomic(path: str, chunks: Iterable[bytes]) -> None:
+    directory = os.path.dirname(path)
+    try:
+        file_descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    except FileNotFoundError:
+        os.makedirs(directory, exist_ok=True)
+        file_descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(file_descriptor, "wb", buffering=HISTORY_IO_BUFFER_SIZE) as file_handle:
+            file_handle.writelines(chunks)
+            file_handle.flush()
+            os.fsync(file_handle.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+@st.cache_resource(show_spinner=False)
+def _get_history_writer() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="history_writer")
+
+
+@functools.lru_cache(maxsize=256)
+def _hash_session_id(session_id: str) -> str:
+    return hashlib.blake2b(session_id.encode("utf-8"), digest_size=16).hexdigest()
+
+
+@st.cache_data(ttl=600, max_entries=50, show_spinner=False)
+def _read_history_image(path: str) -> bytes:
+    # Read errors propagate so that a missing file is not cached as None.
+    with open(path, "rb") as file_handle:
+        return file_handle.read()
+
+
 def _normalize_credential(value: Optional[str]) -> Optional[str]:
     if isinstance(value, str):
         stripped = value.strip()
@@ -72,6 +155,7 @@ def _normalize_credential(value: Optional[str]) -> Optional[str]:
     return None
 
 
+@functools.lru_cache(maxsize=None)
 def get_secret_auth_credentials() -> Tuple[Optional[str], Optional[str]]:
     try:
         secrets_obj = st.secrets
@@ -140,6 +224,14 @@ class BasicSetting:
         login_title: str = "ログイン",
         cookie_controller_state_key: str = "_cookie_controller",
         cookies_sync_stage_key: str = "_cookies_sync_stage",
+        persisted_ids_key: str = "_persisted_ids",
+        persisting_ids_key: str = "_persisting_ids",
+        serialized_cache_key: str = "_serialized_cache",
+        browser_session_state_key: str = "_browser_session_id",
+        history_line_count_key: str = "_history_line_count",
+        cookie_write_state_key: str = "_cookie_written_at",
+        login_js_state_key: str = "_login_js_injected",
+        max_history_entries: int = 100,
     ) -> None:
         self.cookie_key = cookie_key
         self.session_cookie_key = session_cookie_key
@@ -152,6 +244,18 @@ class BasicSetting:
         self.login_title = login_title
         self.cookie_controller_state_key = cookie_controller_state_key
         self.cookies_sync_stage_key = cookies_sync_stage_key
+        self.persisted_ids_key = persisted_ids_key
+        self.persisting_ids_key = persisting_ids_key
+        self.serialized_cache_key = serialized_cache_key
+        self.browser_session_state_key = browser_session_state_key
+        self.history_line_count_key = history_line_count_key
+        self.cookie_write_state_key = cookie_write_state_key
+        self.login_js_state_key = login_js_state_key
+        self.max_history_entries = max_history_entries
+        try:
+            os.makedirs(self.history_dir, exist_ok=True)
+        except OSError:
+            pass
 
     def get_configured_auth_credentials(self) -> Tuple[str, str]:
         secret_username, secret_password = get_secret_auth_credentials()
@@ -171,6 +275,23 @@ class BasicSetting:
             st.session_state[self.cookie_controller_state_key] = controller
         return controller
 
+    def _wait_for_cookie_writes(self) -> None:
+        written_at = st.session_state.pop(self.cookie_write_state_key, None)
+        if written_at is None:
+            return
+        remaining = COOKIE_WRITE_SETTLE_SECONDS - (time.monotonic() - written_at)
+        if remaining > 0:
+            time.sleep(remaining)
+
+    @staticmethod
+    def _refresh_cookies(controller: Any) -> None:
+        try:
+            controller.refresh()
+        except DuplicateWidgetID:
+            # The cookie component already ran in this script run, so the
+            # controller's values are as fresh as another refresh would make them.
+            return
+
     def cookie_controller_available(self) -> bool:
         return self._get_cookie_controller() is not None
 
@@ -181,7 +302,7 @@ class BasicSetting:
         sync_stage = st.session_state.get(self.cookies_sync_stage_key, 0)
         if sync_stage == 0:
             try:
-                controller.refresh()
+                self._refresh_cookies(controller)
             except Exception:
                 return
             st.session_state[self.cookies_sync_stage_key] = 1
@@ -189,7 +310,7 @@ class BasicSetting:
             return
         if sync_stage == 1:
             try:
-                controller.refresh()
+                self._refresh_cookies(controller)
             except Exception:
                 return
             st.session_state[self.cookies_sync_stage_key] = 2
@@ -198,15 +319,13 @@ class BasicSetting:
         controller = self._get_cookie_controller()
         if controller is None:
             return False
-        for _ in range(2):
-            try:
-                controller.refresh()
-                if controller.get(self.cookie_key) == "1":
-                    return True
-            except Exception:
-                return False
-            time.sleep(0.3)
-        return False
+        try:
+            if controller.get(self.cookie_key) == "1":
+                return True
+            self._refresh_cookies(controller)
+            return controller.get(self.cookie_key) == "1"
+        except Exception:
+            return False
 
     def persist_login_to_cookie(self, value: bool) -> None:
         controller = self._get_cookie_controller()
@@ -215,91 +334,211 @@ class BasicSetting:
         try:
             if value:
                 controller.set(self.cookie_key, "1")
-                time.sleep(0.6)
+                st.session_state[self.cookie_write_state_key] = time.monotonic()
             else:
                 controller.remove(self.cookie_key)
         except Exception:
             return
 
-    def _get_history_path(self, session_id: str) -> str:
-        os.makedirs(self.history_dir, exist_ok=True)
-        safe_id = "".join(ch for ch in session_id if ch.isalnum() or ch in {"-", "_"})
-        return os.path.join(self.history_dir, f"{safe_id}.json")
+    @staticmethod
+    def _safe_id(value: str) -> str:
+        return UNSAFE_ID_CHARS.sub("", value)
+
+    def _get_history_path(self, session_id: str, extension: str = "jsonl") -> str:
+        return os.path.join(self.history_dir, f"{_hash_session_id(session_id)}.{extension}")
+
+    def _get_image_dir(self, session_id: str) -> str:
+        return os.path.join(self.history_dir, _hash_session_id(session_id))
+
+    def _migrate_plain_session_files(self, session_id: str) -> None:
+        plain_id = self._safe_id(session_id)
+        if not plain_id:
+            return
+        renames = [
+            (os.path.join(self.history_dir, f"{plain_id}.{extension}"), self._get_history_path(session_id, extension))
+            for extension in ("jsonl", "json")
+        ]
+        renames.append((os.path.join(self.history_dir, plain_id), self._get_image_dir(session_id)))
+        for plain_path, hashed_path in renames:
+            if os.path.exists(hashed_path):
+                continue
+            try:
+                os.rename(plain_path, hashed_path)
+            except OSError:
+                continue
 
     def get_browser_session_id(self, create: bool = True) -> Optional[str]:
+        cached = st.session_state.get(self.browser_session_state_key)
+        if cached:
+            return cached
         controller = self._get_cookie_controller()
         if controller is None:
             return None
         try:
-            controller.refresh()
+            self._refresh_cookies(controller)
             session_id = controller.get(self.session_cookie_key)
         except Exception:
             session_id = None
         if session_id:
+            st.session_state[self.browser_session_state_key] = str(session_id)
             return str(session_id)
         if not create:
             return None
         new_id = uuid.uuid4().hex
         try:
             controller.set(self.session_cookie_key, new_id)
-            time.sleep(0.6)
+            st.session_state[self.cookie_write_state_key] = time.monotonic()
         except Exception:
             return None
+        st.session_state[self.browser_session_state_key] = new_id
         return new_id
 
-    def _serialize_history(self, history: List[Dict[str, object]]) -> List[Dict[str, object]]:
+    def _get_history_image_rel_path(self, session_id: str, image_ref: str) -> str:
+        return os.path.join(_hash_session_id(session_id), "images", f"{self._safe_id(image_ref)}.bin")
+
+    def _write_history_image(self, rel_path: str, image_bytes: bytes) -> bool:
+        image_path = os.path.join(self.history_dir, rel_path)
+        if os.path.exists(image_path):
+            return True
+        try:
+            _write_file_atomic(image_path, [image_bytes])
+        except Exception:
+            return False
+        return True
+
+    def _serialize_history(
+        self, history: List[Dict[str, object]], session_id: str
+    ) -> Tuple[List[Dict[str, object]], List[Tuple[str, bytes]]]:
+        cache: Dict[str, Dict[str, object]] = st.session_state.setdefault(self.serialized_cache_key, {})
         serialized: List[Dict[str, object]] = []
+        image_writes: List[Tuple[str, bytes]] = []
         for entry in history:
+            entry_id = entry.get("id")
+            cached = cache.get(entry_id) if isinstance(entry_id, str) else None
+            if cached is not None:
+                serialized.append(dict(cached))
+                continue
+            image_ref = entry.get("image_ref")
+            image_path = entry.get("image_path")
             image_bytes = entry.get("image_bytes")
-            if isinstance(image_bytes, (bytes, bytearray, memoryview)):
-                image_b64 = base64.b64encode(bytes(image_bytes)).decode("utf-8")
-            else:
-                image_b64 = None
-            serialized.append(
-                {
-                    "id": entry.get("id"),
-                    "prompt": entry.get("prompt"),
-                    "model": entry.get("model"),
-                    "no_text": entry.get("no_text"),
-                    "image_b64": image_b64,
-                }
-            )
-        return serialized
+            if not image_ref and not image_path and isinstance(image_bytes, (bytes, bytearray, memoryview)):
+                image_bytes = bytes(image_bytes)
+                image_ref = hashlib.sha256(image_bytes).hexdigest()
+                image_writes.append((self._get_history_image_rel_path(session_id, image_ref), image_bytes))
+            record = {
+                "id": entry_id,
+                "prompt": entry.get("prompt"),
+                "model": entry.get("model"),
+                "no_text": entry.get("no_text"),
+                "image_ref": image_ref,
+                "image_path": None if image_ref else image_path,
+                "gcs_object": entry.get("gcs_object"),
+            }
+            if isinstance(entry_id, str):
+                cache[entry_id] = record
+            serialized.append(dict(record))
+        return serialized, image_writes
 
-    def _deserialize_history(self, payload: List[Dict[str, object]]) -> List[Dict[str, object]]:
+    def _deserialize_history(self, payload: List[Dict[str, object]], session_id: str) -> List[Dict[str, object]]:
         history: List[Dict[str, object]] = []
         for entry in payload:
             image_b64 = entry.get("image_b64")
             image_bytes = decode_image_data(image_b64) if image_b64 else None
+            image_ref = entry.get("image_ref")
+            image_path = (
+                self._get_history_image_rel_path(session_id, image_ref)
+                if isinstance(image_ref, str) and image_ref
+                else entry.get("image_path")
+            )
             history.append(
                 {
                     "id": entry.get("id"),
                     "prompt": entry.get("prompt"),
                     "model": entry.get("model"),
                     "no_text": entry.get("no_text"),
+                    "image_ref": image_ref,
+                    "image_path": image_path,
+                    "gcs_object": entry.get("gcs_object"),
                     "image_bytes": image_bytes,
                 }
             )
         return history
 
-    def load_history_from_storage(self) -> Optional[List[Dict[str, object]]]:
+    def load_history_image(self, entry: Dict[str, object]) -> Optional[bytes]:
+        image_bytes = entry.get("image_bytes")
+        if image_bytes:
+            return image_bytes
+        image_path = entry.get("image_path")
+        if not isinstance(image_path, str) or not image_path:
+            return None
+        try:
+            return _read_history_image(os.path.join(self.history_dir, image_path))
+        except OSError:
+            return None
+
+    def _migrate_legacy_history(self, session_id: str, history_path: str) -> None:
+        legacy_path = self._get_history_path(session_id, extension="json")
+        try:
+            with open(legacy_path, "rb", buffering=HISTORY_IO_BUFFER_SIZE) as file_handle:
+                payload = _json_loads(file_handle.read())
+        except Exception:
+            return
+        entries = payload.get("history") if isinstance(payload, dict) else None
+        if not isinstance(entries, list):
+            return
+        try:
+            _write_file_atomic(
+                history_path,
+                [_json_dumps(record) + b"\n" for record in reversed(entries) if isinstance(record, dict)],
+            )
+            os.remove(legacy_path)
+        except Exception:
+            return
+
+    def load_history_from_storage(self, limit: Optional[int] = None) -> Optional[List[Dict[str, object]]]:
+        limit = min(limit, self.max_history_entries) if limit else self.max_history_entries
         session_id = self.get_browser_session_id(create=False)
         if not session_id:
             return None
         history_path = self._get_history_path(session_id)
-        if not os.path.exists(history_path):
+        try:
+            file_handle = open(history_path, "rb", buffering=HISTORY_IO_BUFFER_SIZE)
+        except FileNotFoundError:
+            self._migrate_plain_session_files(session_id)
+            if not os.path.exists(history_path):
+                self._migrate_legacy_history(session_id, history_path)
+            try:
+                file_handle = open(history_path, "rb", buffering=HISTORY_IO_BUFFER_SIZE)
+            except OSError:
+                return None
+        except OSError:
             return None
         try:
-            with open(history_path, "r", encoding="utf-8") as file_handle:
-                payload = json.load(file_handle)
+            with file_handle:
+                raw_lines = [line for line in file_handle if line.strip()]
         except Exception:
             return None
-        if not isinstance(payload, dict):
-            return None
-        entries = payload.get("history")
-        if not isinstance(entries, list):
-            return None
-        return self._deserialize_history(entries)
+        st.session_state[self.history_line_count_key] = len(raw_lines)
+        # Records are decoded newest-first and only until `limit` distinct ids
+        # are found, however many superseded or foreign lines sit in between.
+        entries: List[Dict[str, object]] = []
+        seen_ids = set()
+        for line in reversed(raw_lines):
+            try:
+                record = _json_loads(line)
+            except ValueError:
+                continue
+            if not isinstance(record, dict):
+                continue
+            entry_id = record.get("id")
+            if entry_id is not None:
+                if entry_id in seen_ids:
+                    continue
+                seen_ids.add(entry_id)
+            entries.append(record)
+            if len(entries) >= limit:
+                break
+        return self._deserialize_history(entries, session_id)
 
     def persist_history_to_storage(self) -> None:
         session_id = self.get_browser_session_id(create=True)
@@ -309,29 +548,162 @@ class BasicSetting:
         history = st.session_state.get(self.history_state_key, [])
         if not isinstance(history, list):
             return
-        payload = {
-            "updated_at": datetime.datetime.utcnow().isoformat(),
-            "history": self._serialize_history(history),
-        }
+        persisted_ids = st.session_state.setdefault(self.persisted_ids_key, set())
+        persisting_ids = st.session_state.setdefault(self.persisting_ids_key, set())
+        cache = st.session_state.get(self.serialized_cache_key)
+        if isinstance(cache, dict):
+            live_ids = {entry.get("id") for entry in history}
+            for stale_id in [entry_id for entry_id in cache if entry_id not in live_ids]:
+                del cache[stale_id]
+        pending = [
+            entry
+            for entry in reversed(history)
+            if entry.get("id") not in persisted_ids and entry.get("id") not in persisting_ids
+        ]
+        if not pending:
+            return
+        updated_at = time.time()
+        records, image_writes = self._serialize_history(pending, session_id)
+        lines: List[bytes] = []
+        for record in records:
+            record["updated_at"] = updated_at
+            lines.append(_json_dumps(record) + b"\n")
+        writer = _get_history_writer()
+        future = writer.submit(self._append_history_records, history_path, image_writes, lines)
+        # Entries only count as persisted (and only point at their image file)
+        # once resolve_persist_future sees the write succeed.
+        for entry, record in zip(pending, records):
+            image_ref = record.get("image_ref")
+            image_path = self._get_history_image_rel_path(session_id, image_ref) if image_ref else None
+            entry["persist_future"] = (future, image_ref, image_path)
+        persisting_ids.update(entry.get("id") for entry in pending)
+        line_count = st.session_state.get(self.history_line_count_key, 0) + len(lines)
+        if line_count > 2 * self.max_history_entries:
+            writer.submit(self._compact_history_log, history_path, self._get_image_dir(session_id))
+            line_count = self.max_history_entries
+        st.session_state[self.history_line_count_key] = line_count
+
+    def _append_history_records(
+        self, history_path: str, image_writes: List[Tuple[str, bytes]], lines: List[bytes]
+    ) -> bool:
+        for rel_path, image_bytes in image_writes:
+            if not self._write_history_image(rel_path, image_bytes):
+                return False
         try:
-            with open(history_path, "w", encoding="utf-8") as file_handle:
-                json.dump(payload, file_handle)
+            try:
+                file_handle = open(history_path, "ab", buffering=HISTORY_IO_BUFFER_SIZE)
+            except FileNotFoundError:
+                os.makedirs(os.path.dirname(history_path), exist_ok=True)
+                file_handle = open(history_path, "ab", buffering=HISTORY_IO_BUFFER_SIZE)
+            with file_handle:
+                file_handle.writelines(lines)
+        except Exception:
+            return False
+        return True
+
+    def resolve_persist_future(self, entry: Dict[str, object]) -> bool:
+        # Returns True when the write failed and the entry has to be persisted again.
+        pending = entry.get("persist_future")
+        if not pending:
+            return False
+        future, image_ref, image_path = pending
+        if not isinstance(future, Future) or not future.done():
+            return False
+        entry.pop("persist_future", None)
+        try:
+            succeeded = bool(future.result())
+        except Exception:
+            succeeded = False
+        entry_id = entry.get("id")
+        persisting_ids = st.session_state.get(self.persisting_ids_key)
+        in_flight = isinstance(persisting_ids, set) and entry_id in persisting_ids
+        if in_flight:
+            persisting_ids.discard(entry_id)
+        if not succeeded:
+            cache = st.session_state.get(self.serialized_cache_key)
+            if isinstance(cache, dict):
+                cache.pop(entry_id, None)
+            return True
+        if image_ref:
+            entry["image_ref"] = image_ref
+            entry["image_path"] = image_path
+        if in_flight:
+            st.session_state.setdefault(self.persisted_ids_key, set()).add(entry_id)
+        return False
+
+    def _compact_history_log(self, history_path: str, image_dir: str) -> None:
+        # Compacts from the log itself rather than this session's history, so
+        # records written by other tabs sharing the browser id are kept.
+        try:
+            with open(history_path, "rb", buffering=HISTORY_IO_BUFFER_SIZE) as file_handle:
+                raw_lines = [line for line in file_handle if line.strip()]
+        except OSError:
+            return
+        kept_lines: List[bytes] = []
+        kept_ids = set()
+        kept_refs = set()
+        dropped_refs = set()
+        for line in reversed(raw_lines):
+            try:
+                record = _json_loads(line)
+            except ValueError:
+                continue
+            if not isinstance(record, dict):
+                continue
+            entry_id = record.get("id")
+            image_ref = record.get("image_ref")
+            if (entry_id is not None and entry_id in kept_ids) or len(kept_lines) >= self.max_history_entries:
+                if image_ref:
+                    dropped_refs.add(image_ref)
+                continue
+            if entry_id is not None:
+                kept_ids.add(entry_id)
+            if image_ref:
+                kept_refs.add(image_ref)
+            kept_lines.append(line if line.endswith(b"\n") else line + b"\n")
+        kept_lines.reverse()
+        try:
+            _write_file_atomic(history_path, kept_lines)
         except Exception:
             return
+        store_dir = os.path.join(image_dir, "images")
+        for image_ref in dropped_refs - kept_refs:
+            try:
+                os.remove(os.path.join(store_dir, f"{self._safe_id(str(image_ref))}.bin"))
+            except OSError:
+                continue
+
+    def mark_history_entry_changed(self, entry_id: object) -> None:
+        for key in (self.persisted_ids_key, self.persisting_ids_key):
+            ids = st.session_state.get(key)
+            if isinstance(ids, set):
+                ids.discard(entry_id)
+        cache = st.session_state.get(self.serialized_cache_key)
+        if isinstance(cache, dict):
+            cache.pop(entry_id, None)
 
     def clear_history_storage(self) -> None:
+        st.session_state.pop(self.persisted_ids_key, None)
+        st.session_state.pop(self.persisting_ids_key, None)
+        st.session_state.pop(self.serialized_cache_key, None)
+        st.session_state.pop(self.history_line_count_key, None)
         session_id = self.get_browser_session_id(create=False)
         if not session_id:
             return
-        history_path = self._get_history_path(session_id)
-        try:
-            if os.path.exists(history_path):
+        history_paths = [self._get_history_path(session_id, extension=extension) for extension in ("jsonl", "json")]
+        _get_history_writer().submit(self._remove_history_files, history_paths, self._get_image_dir(session_id))
+
+    def _remove_history_files(self, history_paths: List[str], image_dir: str) -> None:
+        for history_path in history_paths:
+            try:
                 os.remove(history_path)
-        except Exception:
-            return
+            except OSError:
+                continue
+        shutil.rmtree(image_dir, ignore_errors=True)
 
     def logout(self) -> None:
         st.session_state[self.auth_state_key] = False
+        st.session_state.pop(self.login_js_state_key, None)
         self.persist_login_to_cookie(False)
         self.clear_history_storage()
         if self.history_state_key in st.session_state:
@@ -406,26 +778,36 @@ class BasicSetting:
             input_password = st.text_input("PASS", type="password")
             submitted = st.form_submit_button("ログイン")
 
-        self.inject_login_autofill_js()
+        if not st.session_state.get(self.login_js_state_key):
+            # The attributes stay on the form inputs across reruns, so the
+            # script only has to run the first time the form is shown.
+            self.inject_login_autofill_js()
+            st.session_state[self.login_js_state_key] = True
 
         if submitted:
-            if input_username == username and input_password == password:
+            username_ok = hmac.compare_digest(input_username.encode("utf-8"), username.encode("utf-8"))
+            password_ok = hmac.compare_digest(input_password.encode("utf-8"), password.encode("utf-8"))
+            if username_ok and password_ok:
                 st.session_state[self.auth_state_key] = True
                 self.persist_login_to_cookie(True)
                 self.get_browser_session_id(create=True)
                 st.success("ログインしました。")
+                self._wait_for_cookie_writes()
                 rerun_app()
                 return
             st.error("IDまたはPASSが正しくありません。")
         st.stop()
 
-    def init_history(self) -> None:
+    def init_history(self, limit: Optional[int] = None) -> None:
         if self.history_state_key not in st.session_state:
             st.session_state[self.history_state_key] = []
         if not st.session_state.get(self.history_loaded_key):
-            restored = self.load_history_from_storage()
+            restored = self.load_history_from_storage(limit)
             if restored is not None:
                 st.session_state[self.history_state_key] = restored
+                st.session_state[self.persisted_ids_key] = {
+                    entry.get("id") for entry in restored if entry.get("id") is not None
+                }
                 st.session_state[self.history_loaded_key] = True
             else:
                 if self.get_browser_session_id(create=False) is not None or not self.cookie_controller_available():
@@ -455,14 +837,26 @@ def get_browser_session_id(create: bool = True) -> Optional[str]:
     return _default_container.get_browser_session_id(create=create)
 
 
-def load_history_from_storage() -> Optional[List[Dict[str, object]]]:
-    return _default_container.load_history_from_storage()
+def load_history_from_storage(limit: Optional[int] = None) -> Optional[List[Dict[str, object]]]:
+    return _default_container.load_history_from_storage(limit)
 
 
 def persist_history_to_storage() -> None:
     return _default_container.persist_history_to_storage()
 
 
+def load_history_image(entry: Dict[str, object]) -> Optional[bytes]:
+    return _default_container.load_history_image(entry)
+
+
+def mark_history_entry_changed(entry_id: object) -> None:
+    return _default_container.mark_history_entry_changed(entry_id)
+
+
+def resolve_persist_future(entry: Dict[str, object]) -> bool:
+    return _default_container.resolve_persist_future(entry)
+
+
 def clear_history_storage() -> None:
     return _default_container.clear_history_storage()
 
@@ -475,5 +869,5 @@ def require_login() -> None:
     return _default_container.require_login()
 
 
-def init_history() -> None:
-    return _default_container.init_history()
+def init_history(limit: Optional[int] = None) -> None:
+    return _default_container.init_history(limit)